@@ -19,7 +19,7 @@ def get_headerset(file):
     tu = idx.parse(file, args= map(lambda x: '-I' + x, includedirs) + ['-DSCIP_WITH_ZLIB'])
 
     headers = set()
-    for idx, c in enumerate(tu.cursor.walk_preorder()):
+    for c in tu.cursor.walk_preorder():
         if str(c.location.file) != file:
             continue
 
@@ -1,13 +1,19 @@
 #! /usr/bin/env python
 
+import array
+import bisect
 import clang.cindex
+import itertools
+import os.path
 import sys
 import clang
-from clang.cindex import CursorKind, TokenKind, StorageClass
+from clang.cindex import CursorKind, TokenKind, StorageClass, SourceLocation, SourceRange, TranslationUnit, \
+    TranslationUnitLoadError, TranslationUnitSaveError
 
 clang.cindex.Config.set_library_file("/usr/lib/llvm-5.0/lib/libclang.so.1")
 
 gap_file_name = "gaps_file.txt"
+ast_file_suffix = ".ast"
 
 import argparse
 
@@ -19,136 +25,255 @@ parser.add_argument('files', nargs=2, help='c file and header file')
 
 args = parser.parse_args()
 
+#
+# cache of fully qualified names by cursor hash, functions usually share most of their semantic parents
+#
+fully_qualified_names = {}
+
 def fully_qualified(c):
-    if c is None:
-        return ''
-    elif c.kind == CursorKind.TRANSLATION_UNIT:
-        return ''
-    else:
-        res = fully_qualified(c.semantic_parent)
-        if res != '':
-            return res + '::' + c.spelling
-    return c.spelling
-
-def recurse_into_static_functions(cursor, static_functions_dict):
-    for d in cursor.walk_preorder():
-        if d.kind == CursorKind.CALL_EXPR and d.referenced.storage_class == StorageClass.STATIC:
-                                #print "\t->{}".format(fully_qualified(d.referenced))
-            if d.referenced.extent.start.line not in static_functions_dict:
-                static_functions_dict[d.referenced.extent.start.line] = d.referenced
-                recurse_into_static_functions(d.referenced, static_functions_dict)
+    #
+    # climb up the semantic parents until the translation unit or an already known parent is reached
+    #
+    parents = []
+    name = ''
+    while c is not None and c.kind != CursorKind.TRANSLATION_UNIT:
+        h = c.hash
+        if h in fully_qualified_names:
+            name = fully_qualified_names[h]
+            break
+        parents.append((h, c.spelling))
+        c = c.semantic_parent
 
+    #
+    # build the names of the visited cursors from the outermost one downwards and remember them
+    #
+    for h, spelling in reversed(parents):
+        name = name + '::' + spelling if name != '' else spelling
+        fully_qualified_names[h] = name
 
-if __name__ == "__main__":
+    return name
 
-    header_functions_idx = clang.cindex.Index.create()
-    tu  = header_functions_idx.parse(args.files[1], args=['-I../../src'])
-    header_functions = set()
-    for c in tu.cursor.walk_preorder():
-        if c.kind == CursorKind.FUNCTION_DECL and str(c.location.file) == args.files[1]:
-            header_functions.add(c.spelling)
-
-    idx = clang.cindex.Index.create()
-    tu = idx.parse(args.files[0], args=['-I../../src'])
+def collect_functions(module_cursors, header_functions):
+    #
+    # walk the top level cursors of the module once with an explicit stack. Every entry carries a flag
+    # whether calls to static functions below it are collected, i.e., whether it lies inside a
+    # function of the header module or inside a static function called (transitively) by one of them.
+    # Called static functions are pushed onto the same stack instead of being walked separately.
+    #
+    # function definitions are always top level cursors, so the walk starts at the top level cursors
+    # of the module itself, skipping everything pulled in by includes, and only descends into the
+    # cursors whose calls are collected
+    #
+    # the walk visits every cursor of the collected functions, so the loop invariant enum values and
+    # methods are bound to local names once
+    #
+    function_decl = CursorKind.FUNCTION_DECL
+    call_expr = CursorKind.CALL_EXPR
+    static = StorageClass.STATIC
 
     function_dict = {}
-    kindtypes = dict()
-    static_functions_dict = dict()
-    for idx, c in enumerate(tu.cursor.walk_preorder()):
-
-        kindtypes[c.kind] = kindtypes.get(c.kind, 0) + 1
-
-
-        if c.kind == CursorKind.FUNCTION_DECL and c.get_definition() is not None:
+    static_functions = []
+    static_functions_seen = set()
+    add_seen = static_functions_seen.add
+    add_static = static_functions.append
+
+    stack = [(c, False) for c in reversed(module_cursors)]
+    pop = stack.pop
+    push = stack.append
+    extend = stack.extend
+    while stack:
+        c, collect = pop()
+        kind = c.kind
+
+        if kind == function_decl and c.get_definition() is not None:
             #print("\n".join(dir(c)))
             #sys.exit(0)
             if str(c.location.file).endswith("c"):
 
-                if c.storage_class == StorageClass.STATIC:
-                    #print "{} : {}--{}".format(fully_qualified(c.referenced), c.extent.start.line,
-                    #
-                    #c.extent.end.line)
-                    pass
-
-
                 if c.referenced.spelling in header_functions:
                     #print "{} : {}--{}".format(fully_qualified(c.referenced), c.extent.start.line, c.extent.end.line)
 
                     function_dict[c.extent.start.line] = c
+                    collect = True
+
+        elif collect and kind == call_expr:
+            #
+            # calls through function pointers need not reference any declaration
+            #
+            referenced = c.referenced
+            if referenced is not None and referenced.storage_class == static:
+                #print "\t->{}".format(fully_qualified(referenced))
+                h = referenced.hash
+                if h not in static_functions_seen:
+                    add_seen(h)
+                    add_static(referenced)
+                    push((referenced, True))
+
+        if collect:
+            extend((d, True) for d in reversed(list(c.get_children())))
+
+    return function_dict, static_functions
+
+#
+# file names of a translation unit loaded from an AST file are absolute, so file names are compared by
+# their real paths, which are cached since a translation unit only references a few distinct files
+#
+real_paths = {}
+
+def real_path(f):
+    name = str(f)
+    if name not in real_paths:
+        real_paths[name] = os.path.realpath(name)
+    return real_paths[name]
+
+def parse_module(idx, filename):
+    #
+    # the same module is parsed once for every header it is split into, so the parsed module is saved
+    # and reused as long as neither the module nor any of its includes changed afterwards; filename
+    # has to be a real path
+    #
+    ast_file_name = os.path.basename(filename) + ast_file_suffix
+    if os.path.isfile(ast_file_name):
+        try:
+            tu = TranslationUnit.from_ast_file(ast_file_name, idx)
+        except TranslationUnitLoadError:
+            tu = None
+
+        if tu is not None and real_path(tu.spelling) == filename:
+            ast_time = os.path.getmtime(ast_file_name)
+            sources = [filename] + [real_path(i.include) for i in tu.get_includes()]
+            if all(os.path.isfile(f) and os.path.getmtime(f) <= ast_time for f in sources):
+                return tu
+
+    tu = idx.parse(filename, args=['-I../../src'])
+
+    # the cache is only an optimization, failing to write it is not an error
+    try:
+        tu.save(ast_file_name)
+    except TranslationUnitSaveError:
+        pass
 
-                    recurse_into_static_functions(c, static_functions_dict)
+    return tu
 
 
+if __name__ == "__main__":
+
+    header_functions_idx = clang.cindex.Index.create()
+    tu  = header_functions_idx.parse(args.files[1], args=['-I../../src'], options=TranslationUnit.PARSE_SKIP_FUNCTION_BODIES)
+
+    #
+    # function declarations in a C header are always at file scope, so it suffices to look at the
+    # top level cursors instead of descending into every declaration of every included header; the
+    # bodies of inline functions are not needed for that and are skipped while parsing
+    #
+    header_functions = set()
+    for c in tu.cursor.get_children():
+        if c.kind == CursorKind.FUNCTION_DECL and str(c.location.file) == args.files[1]:
+            header_functions.add(c.spelling)
+
+    idx = clang.cindex.Index.create()
+    module_name = real_path(args.files[0])
+    tu = parse_module(idx, module_name)
+
+    module_cursors = [c for c in tu.cursor.get_children() if real_path(c.location.file) == module_name]
+    function_dict, static_functions = collect_functions(module_cursors, header_functions)
+
+    #
+    # the functions of the current header module by their start line in the module, header functions
+    # take precedence over static functions starting in the same line
+    #
+    functions = dict((f.extent.start.line, f) for f in static_functions if real_path(f.location.file) == module_name)
+    functions.update(function_dict)
 
-    #print "\n".join(map(str, kindtypes.items()))
     #
     # loop over documentation that and keep merge tokens that are doxygen comments directly before
     # the start of a new function declaration
     #
+    # instead of lexing the whole module, only the tokens between the end of the preceding top level
+    # cursor and the start of each function are lexed, which contain the documentation of the function
+    #
+    module_file = tu.get_file(module_name)
+    module_starts = [c.extent.start.line for c in module_cursors]
+    comment_kind = TokenKind.COMMENT
+    get_tokens = tu.get_tokens
     lines = []
-    for c in tu.cursor.get_tokens():
+    for linenumber in sorted(functions):
+        function = functions[linenumber]
 
-        # stop at every comment token
-        if c.kind == TokenKind.COMMENT:
-            nextlinenumber = c.extent.end.line + 1
+        previous = bisect.bisect_left(module_starts, linenumber) - 1
+        if previous >= 0:
+            rangestart = module_cursors[previous].extent.end
+        else:
+            rangestart = SourceLocation.from_position(tu, module_file, 1, 1)
+        rangeend = SourceLocation.from_position(tu, module_file, linenumber, 1)
 
-            #
-            # is this function part of the current header module?
-            #
-            if  nextlinenumber in function_dict or nextlinenumber in static_functions_dict:
+        #
+        # the documentation ends in the line before the function, so the tokens are inspected from the
+        # back of the range until the first token ending in an earlier line, and the extent of every
+        # inspected token is only fetched once
+        #
+        comments = []
+        for c in reversed(list(get_tokens(extent=SourceRange.from_locations(rangestart, rangeend)))):
+            extent = c.extent
+            endline = extent.end.line
+            if endline < linenumber - 1:
+                break
+
+            # stop at every comment token that ends directly before the function
+            if endline == linenumber - 1 and c.kind == comment_kind:
 
                 # uncomment to print the documentation
                 #print c.spelling
-                thedict = function_dict if nextlinenumber in function_dict else static_functions_dict
-                function = thedict[nextlinenumber]
-                functionname = fully_qualified(function.referenced)
+                comments.append(extent.start.line)
 
-                #
-                # print the whole extent from the beginning to the end.
-                #
-                #output(functionname, c.extent.start.line, function.extent.end.line)
-                lines.append((c.extent.start.line, function.extent.end.line))
+        functionend = function.extent.end.line
+        functionname = fully_qualified(function.referenced)
+        for commentstart in reversed(comments):
+            #
+            # print the whole extent from the beginning to the end.
+            #
+            #output(functionname, commentstart, functionend)
+            lines.append((commentstart, functionend))
 
     if args.write_gaps:
         with open(gap_file_name, "w") as gap_file:
-            start = 1
-            i = 0
-            gaplist = []
-            while i < len(lines) - 1:
-                _ , start = lines[i]
-                end , _ = lines[i+1]
-                if start + 1 <= end - 1:
-                    gaplist.append((start + 1, end - 1))
-                i += 1
-
-            for (start, end) in gaplist:
-                if start <= end:
-                    gap_file.write("{} {}\n".format(start, end))
+            #
+            # a gap is everything strictly between the end of a function and the next documentation
+            #
+            gap_file.write("".join("{} {}\n".format(start + 1, end - 1)
+                    for ((_, start), (end, _)) in zip(lines, lines[1:]) if start + 1 <= end - 1))
     elif len(lines) > 0:
 
         #
         # try to open a possibly created gap file
         #
         with open(gap_file_name, "r") as gap_file:
-            gaps = {}
-            for  line in gap_file:
-                gaps_line = map(int, line.split())
-                gaps[gaps_line[0]] = gaps_line[1]
+            #
+            # the gap file is written in ascending order of the gap starts, keep the starts and ends
+            # in two compact arrays. The lines are collected in ascending order, too, such that the
+            # gaps can be scanned along with them.
+            #
+            gaps = array.array('i', map(int, gap_file.read().split()))
+            gap_starts = gaps[0::2]
+            gap_ends = gaps[1::2]
+            ngaps = len(gap_starts)
+            gap = 0
             start,end = lines[0]
             end+= 1
             merged_lines = []
-            i = 0
-            while i < len(lines) - 1:
-                nextstart,nextend = lines[i+1]
+            for (nextstart,nextend) in itertools.islice(lines, 1, None):
                 nextend += 1
-                if end in gaps and gaps[end] == nextstart - 1:
+                while gap < ngaps and gap_starts[gap] < end:
+                    gap += 1
+                if gap < ngaps and gap_starts[gap] == end and gap_ends[gap] == nextstart - 1:
                     end = nextend
                 else:
                     merged_lines.append((start,end))
                     start,end = (nextstart,nextend)
-                i += 1
             merged_lines.append((start,end - 1))
             lines = merged_lines
 
-        for (start,end) in lines:
-            print "{},{}p".format(start,end)
+        #
+        # write all sed commands at once instead of one print per line
+        #
+        sys.stdout.write("".join("{},{}p\n".format(start,end) for (start,end) in lines))